@@ -1,31 +1,128 @@
 #!/usr/bin/env python3
-from aws_cdk import App, Aspects
-from cdk_nag import AwsSolutionsChecks
+import contextlib
+import glob
+import hashlib
+import os
+import sys
 
-from src.amplify_add_on_stack import CustomAmplifyDistributionStack
-from src.web_acl_stack import CustomWebAclStack
+from src.context import get_flag
 
-app = App()
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+INPUT_HASH_FILE = ".input-hash"
 
-CustomWebAclStack(
-    app,
-    "CustomWebAclStack",
-    description="This stack creates WebACL to be attached to a CloudFront distribution \
-        for a Web App hosted with Amplify",
-    env={"region": "us-east-1"},
+# Kept identical to the original backslash-continued descriptions, including
+# the indentation that ended up inside them, so the deployed stacks don't change
+WEB_ACL_STACK_DESCRIPTION = (
+    "This stack creates WebACL to be attached to a CloudFront distribution "
+    "        for a Web App hosted with Amplify"
 )
-CustomAmplifyDistributionStack(
-    app,
-    "CustomAmplifyDistributionStack",
-    description="This stack creates a custom CloudFront distribution pointing to \
-        Amplify app's default CloudFront distribution. \
-        It also enables Basic Auth protection on specified branch. \
-        Creates event based setup for invalidating custom CloudFront distribution when \
-        a new version of Amplify App is deployed.",
-    web_acl_arn=app.node.try_get_context("web_acl_arn"),
-    app_id=app.node.try_get_context("app_id"),
-    branch_name=app.node.try_get_context("branch_name"),
+AMPLIFY_DISTRIBUTION_STACK_DESCRIPTION = (
+    "This stack creates a custom CloudFront distribution pointing to "
+    "        Amplify app's default CloudFront distribution. "
+    "        It also enables Basic Auth protection on specified branch. "
+    "        Creates event based setup for invalidating custom CloudFront distribution when "
+    "        a new version of Amplify App is deployed."
 )
 
-Aspects.of(app).add(AwsSolutionsChecks())
+
+def get_config(app):
+    """Group the stack parameter lookups from the CDK context."""
+    return tuple(
+        app.node.try_get_context(key)
+        for key in ("web_acl_arn", "app_id", "branch_name")
+    )
+
+
+def get_input_hash():
+    """Hash everything that shapes the cloud assembly: context, env and sources."""
+    digest = hashlib.sha256()
+    for name in ("CDK_CONTEXT_JSON", "CDK_DEFAULT_ACCOUNT", "CDK_DEFAULT_REGION"):
+        digest.update(os.environ.get(name, "").encode())
+    # Every file under src/, Lambda assets are packaged from it whole
+    paths = [
+        os.path.join(ROOT_DIR, "app.py"),
+        os.path.join(ROOT_DIR, "requirements.txt"),
+    ] + sorted(
+        path
+        for path in glob.glob(os.path.join(ROOT_DIR, "src", "**"), recursive=True)
+        if os.path.isfile(path) and "__pycache__" not in path.split(os.sep)
+    )
+    for path in paths:
+        digest.update(os.path.relpath(path, ROOT_DIR).encode())
+        with open(path, "rb") as source:
+            digest.update(source.read())
+    return digest.hexdigest()
+
+
+def is_synthesized(outdir, input_hash):
+    """Whether outdir already holds a cloud assembly built from the same inputs."""
+    try:
+        with open(os.path.join(outdir, INPUT_HASH_FILE)) as stored:
+            return stored.read() == input_hash and os.path.exists(
+                os.path.join(outdir, "manifest.json")
+            )
+    except FileNotFoundError:
+        return False
+
+
+# Reuse the cloud assembly left by a previous run when nothing has changed,
+# e.g. "cdk synth" followed by "cdk deploy" in CI. This runs before aws_cdk
+# is imported, since starting the jsii runtime is most of the synth time.
+outdir = os.environ.get("CDK_OUTDIR")
+input_hash = get_input_hash()
+if outdir and is_synthesized(outdir, input_hash):
+    sys.exit(0)
+
+from aws_cdk import App, Aspects  # noqa: E402 isort:skip
+
+app = App(auto_synth=False)
+
+web_acl_arn, app_id, branch_name = get_config(app)
+
+# Limit synthesis to one stack with "-c stacks=waf" or "-c stacks=amplify"
+stacks = app.node.try_get_context("stacks")
+if stacks not in (None, "all", "waf", "amplify"):
+    raise ValueError(
+        f'Invalid stacks context value {stacks!r}, expected "all", "waf" or "amplify"'
+    )
+
+if stacks in (None, "all", "waf"):
+    from src.web_acl_stack import CustomWebAclStack
+
+    CustomWebAclStack(
+        app,
+        "CustomWebAclStack",
+        description=WEB_ACL_STACK_DESCRIPTION,
+        env={"region": "us-east-1"},
+    )
+
+if stacks in (None, "all", "amplify"):
+    from src.amplify_add_on_stack import CustomAmplifyDistributionStack
+
+    CustomAmplifyDistributionStack(
+        app,
+        "CustomAmplifyDistributionStack",
+        description=AMPLIFY_DISTRIBUTION_STACK_DESCRIPTION,
+        web_acl_arn=web_acl_arn,
+        app_id=app_id,
+        branch_name=branch_name,
+    )
+
+# "-c fast=1" skips cdk-nag, tracing and log retention for quick iteration
+fast = get_flag(app.node, "fast")
+
+if get_flag(app.node, "nag") and not fast:
+    from cdk_nag import AwsSolutionsChecks
+
+    Aspects.of(app).add(AwsSolutionsChecks())
+
+# Drop the previous hash first, so an interrupted synth never looks up to date
+if outdir:
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(os.path.join(outdir, INPUT_HASH_FILE))
+
 app.synth()
+
+if outdir:
+    with open(os.path.join(outdir, INPUT_HASH_FILE), "w") as stored:
+        stored.write(input_hash)
@@ -1,21 +1,111 @@
+import functools
 import os
 from urllib.parse import quote
 
 import aws_cdk.aws_cloudfront as cloudfront
 import aws_cdk.aws_cloudfront_origins as origins
-from aws_cdk import Aws, CfnOutput, CustomResource, Duration, Stack
+from aws_cdk import Aws, CfnOutput, CustomResource, Duration, RemovalPolicy, Stack
 from aws_cdk import aws_events as events
 from aws_cdk import aws_events_targets as targets
 from aws_cdk import aws_iam as iam
 from aws_cdk import aws_secretsmanager as secrets
 from aws_cdk import custom_resources as custom
 from aws_cdk.aws_lambda import Code, Function, Runtime, Tracing
-from aws_cdk.aws_logs import RetentionDays
-from cdk_nag import NagSuppressions
+from aws_cdk.aws_logs import LogGroup, RetentionDays
 from constructs import Construct
 
+from src.context import get_flag
+
 dirname = os.path.dirname(__file__)
 
+PASSWORD_RETRIEVAL_ASSET_PATH = os.path.join(dirname, "functions/password_retrieval")
+CACHE_INVALIDATION_ASSET_PATH = os.path.join(dirname, "functions/cache_invalidation")
+
+LAMBDA_BASIC_EXECUTION_POLICY_ARN = (
+    "arn:aws:iam::aws:policy/service-role/AWSLambdaBasicExecutionRole"
+)
+LAMBDA_SERVICE_PRINCIPAL = "lambda.amazonaws.com"
+
+
+def get_log_retention(node):
+    """Read the log_retention context value as a RetentionDays member, if set."""
+    name = node.try_get_context("log_retention")
+    if not name:
+        return None
+    try:
+        return RetentionDays[str(name)]
+    except KeyError:
+        raise ValueError(
+            f"Invalid log_retention {name!r}, expected one of: "
+            f"{', '.join(RetentionDays.__members__)}"
+        ) from None
+
+
+@functools.lru_cache(maxsize=None)
+def _lambda_service_principal():
+    """Shared Lambda service principal, it is not scoped to a construct."""
+    return iam.ServicePrincipal(LAMBDA_SERVICE_PRINCIPAL)
+
+
+# cdk-nag suppression payloads, built once and shared by every stack instance
+_IAM4_SUPPRESSION = {
+    "id": "AwsSolutions-IAM4",
+    "reason": "CDK generated service role and policy",
+}
+_IAM5_SUPPRESSION = {
+    "id": "AwsSolutions-IAM5",
+    "reason": "CDK generated service role and policy",
+}
+_L1_SUPPRESSION = {
+    "id": "AwsSolutions-L1",
+    "reason": "CDK generated custom resource",
+}
+_CDK_GENERATED_ROLE_SUPPRESSIONS = (_IAM4_SUPPRESSION, _IAM5_SUPPRESSION)
+_CDK_GENERATED_FUNCTION_SUPPRESSIONS = _CDK_GENERATED_ROLE_SUPPRESSIONS + (
+    _L1_SUPPRESSION,
+)
+_SECRET_SUPPRESSIONS = (
+    {
+        "id": "AwsSolutions-SMG4",
+        "reason": "user to retrigger rotation by recreating stack",
+    },
+)
+_DISTRIBUTION_SUPPRESSIONS = (
+    {
+        "id": "AwsSolutions-CFR1",
+        "reason": "geo restictions to be enabled using WAF by user",
+    },
+    {
+        "id": "AwsSolutions-CFR3",
+        "reason": "user to override the logging property as required",
+    },
+    {
+        "id": "AwsSolutions-CFR4",
+        "reason": "user to override when using a custom domain and certificate",
+    },
+)
+
+# cdk-nag suppressions for CDK generated singletons, "{sn}" is the stack name
+_PATH_SUPPRESSIONS = (
+    (
+        "/{sn}/AWS679f53fac002430cb0da5b7982bd2287/ServiceRole/Resource",
+        (_IAM4_SUPPRESSION,),
+    ),
+    ("/{sn}/AWS679f53fac002430cb0da5b7982bd2287/Resource", (_L1_SUPPRESSION,)),
+)
+
+# Only present when log retention is set through the LogRetention resource
+_LOG_RETENTION_PATH_SUPPRESSIONS = (
+    (
+        "/{sn}/LogRetentionaae0aa3c5b4d4f87b02d85b201efdd8a/ServiceRole/Resource",
+        (_IAM4_SUPPRESSION,),
+    ),
+    (
+        "/{sn}/LogRetentionaae0aa3c5b4d4f87b02d85b201efdd8a/ServiceRole/DefaultPolicy/Resource",
+        (_IAM5_SUPPRESSION,),
+    ),
+)
+
 
 class CustomAmplifyDistributionStack(Stack):
     def __init__(
@@ -29,6 +119,29 @@ class CustomAmplifyDistributionStack(Stack):
     ):
         super().__init__(scope, id, **kwargs)
 
+        # Format amplify branch for ARNs and the Amplify domain name
+        encoded_branch = quote(branch_name, safe="")
+        formatted_amplify_branch = branch_name.replace("/", "-")
+
+        # Lambda tracing and log retention, configured in cdk.json context
+        # and always off in fast mode
+        fast = get_flag(self.node, "fast")
+        tracing = (
+            Tracing.ACTIVE
+            if get_flag(self.node, "enable_tracing") and not fast
+            else Tracing.DISABLED
+        )
+        log_retention = None if fast else get_log_retention(self.node)
+        # Explicit log groups only deploy when no /aws/lambda/<function> group
+        # exists yet, otherwise retention goes through the LogRetention resource
+        explicit_log_groups = get_flag(self.node, "explicit_log_groups")
+        function_log_retention = None if explicit_log_groups else log_retention
+        # Explicit log groups stay in the template even without retention, dropping
+        # them would delete the groups and every log in them
+        explicit_log_retention = (
+            RetentionDays.INFINITE if log_retention is None else log_retention
+        )
+
         amplify_username = secrets.Secret(
             self,
             "rAmplifyUsername",
@@ -51,7 +164,7 @@ class CustomAmplifyDistributionStack(Stack):
         lambda_exec_policy = iam.ManagedPolicy.from_managed_policy_arn(
             self,
             "lambda-exec-policy-00",
-            managed_policy_arn="arn:aws:iam::aws:policy/service-role/AWSLambdaBasicExecutionRole",
+            managed_policy_arn=LAMBDA_BASIC_EXECUTION_POLICY_ARN,
         )
 
         # Amplify Credential Retrieval Lambda Execution Role
@@ -59,7 +172,7 @@ class CustomAmplifyDistributionStack(Stack):
             self,
             "rAmplifyCredentialsRetrievalFunctionRole",
             description="Role used by amplify_credentials_retrieval_function lambda function",
-            assumed_by=iam.ServicePrincipal("lambda.amazonaws.com"),
+            assumed_by=_lambda_service_principal(),
         )
 
         amplify_credentials_retrieval_function_role.add_managed_policy(
@@ -76,14 +189,12 @@ class CustomAmplifyDistributionStack(Stack):
             description="custom function to retrieve value of scecrets that contain amplify auth info",  # noqa 501
             runtime=Runtime.PYTHON_3_9,
             handler="lambda_function.lambda_handler",
-            code=Code.from_asset(
-                path=os.path.join(dirname, "functions/password_retrieval")
-            ),
+            code=Code.from_asset(path=PASSWORD_RETRIEVAL_ASSET_PATH),
             timeout=Duration.seconds(30),
             memory_size=128,
             role=amplify_credentials_retrieval_function_role,
-            tracing=Tracing.ACTIVE,
-            log_retention=RetentionDays.SIX_MONTHS,
+            tracing=tracing,
+            log_retention=function_log_retention,
             environment={
                 "USERNAME_SECRET_ARN": amplify_username.secret_full_arn,
                 "CREDENTIALS_SECRET_ARN": amplify_password.secret_full_arn,
@@ -103,52 +214,51 @@ class CustomAmplifyDistributionStack(Stack):
             properties={},
         )
 
+        # Create the log group before the function is first invoked by this resource
+        if explicit_log_groups:
+            amplify_auth_value.node.add_dependency(
+                self._add_log_group(
+                    "rAmplifyCredentialsRetrievalFunctionLogGroup",
+                    amplify_credentials_retrieval_function,
+                    explicit_log_retention,
+                )
+            )
+
+        amplify_auth_credentials = amplify_auth_value.get_att_string(
+            "EncodedCredentials"
+        )
+        authorization_header = amplify_auth_value.get_att_string("EncodedSuffix")
+        custom_headers = {"Authorization": authorization_header}
+
+        branch_arn = f"arn:aws:amplify:{Aws.REGION}:{Aws.ACCOUNT_ID}:apps/{app_id}/branches/{encoded_branch}"
+
+        branch_update_call = custom.AwsSdkCall(
+            service="Amplify",
+            action="updateBranch",
+            parameters={
+                "appId": app_id,
+                "branchName": branch_name,
+                "enableBasicAuth": True,
+                "basicAuthCredentials": amplify_auth_credentials,
+            },
+            physical_resource_id=custom.PhysicalResourceId.of(
+                f"amplify-branch-update-{app_id}-{formatted_amplify_branch}"
+            ),
+        )
+
         app_branch_update = custom.AwsCustomResource(
             self,
             "rAmplifyAppBranchUpdate",
             policy=custom.AwsCustomResourcePolicy.from_sdk_calls(
-                resources=[
-                    f"arn:aws:amplify:{Aws.REGION}:{Aws.ACCOUNT_ID}:apps/{app_id}/branches/{quote(branch_name, safe='')}",
-                ]
-            ),
-            on_create=custom.AwsSdkCall(
-                service="Amplify",
-                action="updateBranch",
-                parameters={
-                    "appId": app_id,
-                    "branchName": branch_name,
-                    "enableBasicAuth": True,
-                    "basicAuthCredentials": amplify_auth_value.get_att_string(
-                        "EncodedCredentials"
-                    ),
-                },
-                physical_resource_id=custom.PhysicalResourceId.of(
-                    "amplify-branch-update"
-                ),
-            ),
-            on_update=custom.AwsSdkCall(
-                service="Amplify",
-                action="updateBranch",
-                parameters={
-                    "appId": app_id,
-                    "branchName": branch_name,
-                    "enableBasicAuth": True,
-                    "basicAuthCredentials": amplify_auth_value.get_att_string(
-                        "EncodedCredentials"
-                    ),
-                },
-                physical_resource_id=custom.PhysicalResourceId.of(
-                    "amplify-branch-update"
-                ),
+                resources=[branch_arn]
             ),
+            on_create=branch_update_call,
+            on_update=branch_update_call,
+            install_latest_aws_sdk=False,
         )
 
-        app_branch_update.node.add_dependency(amplify_auth_value)
         app_branch_update.node.add_dependency(amplify_auth_value)
 
-        # Format amplify branch
-        formatted_amplify_branch = branch_name.replace("/", "-")
-
         # Define cloudfront distribution
         amplify_app_distribution = cloudfront.Distribution(
             self,
@@ -156,11 +266,7 @@ class CustomAmplifyDistributionStack(Stack):
             default_behavior=cloudfront.BehaviorOptions(
                 origin=origins.HttpOrigin(
                     domain_name=f"{formatted_amplify_branch}.{app_id}.amplifyapp.com",
-                    custom_headers={
-                        "Authorization": amplify_auth_value.get_att_string(
-                            "EncodedSuffix"
-                        )
-                    },
+                    custom_headers=custom_headers,
                 ),
                 viewer_protocol_policy=cloudfront.ViewerProtocolPolicy.REDIRECT_TO_HTTPS,
             ),
@@ -171,35 +277,28 @@ class CustomAmplifyDistributionStack(Stack):
         amplify_app_distribution.node.add_dependency(amplify_auth_value)
 
         self.amplify_app_distribution = amplify_app_distribution
+        distribution_id = amplify_app_distribution.distribution_id
+
+        account_cf_arn_prefix = f"arn:aws:cloudfront::{Aws.ACCOUNT_ID}:distribution/"
 
         # CloudFront cache invalidation Lambda Execution Role
         cache_invalidation_function_role = iam.Role(
             self,
             "rCacheInvalidationFunctionCustomRole",
             description="Role used by cache_invalidation lambda function",
-            assumed_by=iam.ServicePrincipal("lambda.amazonaws.com"),
+            assumed_by=_lambda_service_principal(),
         )
 
         cache_invalidation_function_role.add_managed_policy(lambda_exec_policy)
 
-        cache_invalidation_function_custom_policy = iam.ManagedPolicy(
-            self,
-            "rCacheInvalidationFunctionCustomPolicy",
-            statements=[
-                iam.PolicyStatement(
-                    effect=iam.Effect.ALLOW,
-                    actions=[
-                        "cloudfront:CreateInvalidation",
-                    ],
-                    resources=[
-                        f"arn:aws:cloudfront::{Aws.ACCOUNT_ID}:distribution/{amplify_app_distribution.distribution_id}"
-                    ],
-                ),
-            ],
-        )
-
-        cache_invalidation_function_role.add_managed_policy(
-            cache_invalidation_function_custom_policy
+        cache_invalidation_function_role.add_to_policy(
+            iam.PolicyStatement(
+                effect=iam.Effect.ALLOW,
+                actions=[
+                    "cloudfront:CreateInvalidation",
+                ],
+                resources=[f"{account_cf_arn_prefix}{distribution_id}"],
+            )
         )
 
         # Function to trigger CloudFront invalidation
@@ -209,20 +308,18 @@ class CustomAmplifyDistributionStack(Stack):
             description="custom function to trigger cloudfront cache invalidation",  # noqa 501
             runtime=Runtime.PYTHON_3_9,
             handler="lambda_function.lambda_handler",
-            code=Code.from_asset(
-                path=os.path.join(dirname, "functions/cache_invalidation")
-            ),
+            code=Code.from_asset(path=CACHE_INVALIDATION_ASSET_PATH),
             timeout=Duration.seconds(30),
             memory_size=128,
             role=cache_invalidation_function_role,
-            tracing=Tracing.ACTIVE,
-            log_retention=RetentionDays.SIX_MONTHS,
+            tracing=tracing,
+            log_retention=function_log_retention,
             environment={
-                "DISTRIBUTION_ID": amplify_app_distribution.distribution_id,
+                "DISTRIBUTION_ID": distribution_id,
             },
         )
 
-        events.Rule(
+        cache_invalidation_rule = events.Rule(
             self,
             "rInvokeCacheInvalidation",
             description="Rule is triggered when the Amplify app is redeployed, which creates a CloudFront cache invalidation request",  # noqa E501
@@ -240,6 +337,15 @@ class CustomAmplifyDistributionStack(Stack):
             ],
         )
 
+        if explicit_log_groups:
+            cache_invalidation_rule.node.add_dependency(
+                self._add_log_group(
+                    "rCacheInvalidationFunctionLogGroup",
+                    cache_invalidation_function,
+                    explicit_log_retention,
+                )
+            )
+
         CfnOutput(
             self,
             "oCloudFrontDistributionDomain",
@@ -247,152 +353,73 @@ class CustomAmplifyDistributionStack(Stack):
         )
 
         # Stack Suppressions
-        NagSuppressions.add_resource_suppressions(
-            amplify_username,
-            suppressions=[
-                {
-                    "id": "AwsSolutions-SMG4",
-                    "reason": "user to retrigger rotation by recreating stack",
-                }
-            ],
-        )
-
-        NagSuppressions.add_resource_suppressions(
-            amplify_password,
-            suppressions=[
-                {
-                    "id": "AwsSolutions-SMG4",
-                    "reason": "user to retrigger rotation by recreating stack",
-                }
-            ],
-        )
-
-        NagSuppressions.add_resource_suppressions(
-            amplify_app_distribution,
-            suppressions=[
-                {
-                    "id": "AwsSolutions-CFR1",
-                    "reason": "geo restictions to be enabled using WAF by user",
-                },
-                {
-                    "id": "AwsSolutions-CFR3",
-                    "reason": "user to override the logging property as required",
-                },
-                {
-                    "id": "AwsSolutions-CFR4",
-                    "reason": "user to override when using a custom domain and certificate",
-                },
-            ],
-        )
-
-        NagSuppressions.add_resource_suppressions(
-            cache_invalidation_function_role,
-            suppressions=[
-                {
-                    "id": "AwsSolutions-IAM4",
-                    "reason": "CDK generated service role and policy",
-                },
-                {
-                    "id": "AwsSolutions-IAM5",
-                    "reason": "CDK generated service role and policy",
-                },
-                {
-                    "id": "AwsSolutions-L1",
-                    "reason": "CDK generated custom resource",
-                },
-            ],
-            apply_to_children=True,
-        )
-
-        NagSuppressions.add_resource_suppressions(
-            password_provider,
-            suppressions=[
-                {
-                    "id": "AwsSolutions-IAM4",
-                    "reason": "CDK generated service role and policy",
-                },
-                {
-                    "id": "AwsSolutions-IAM5",
-                    "reason": "CDK generated service role and policy",
-                },
-                {
-                    "id": "AwsSolutions-L1",
-                    "reason": "CDK generated custom resource",
-                },
-            ],
-            apply_to_children=True,
-        )
-
-        NagSuppressions.add_resource_suppressions(
-            amplify_credentials_retrieval_function_role,
-            suppressions=[
-                {
-                    "id": "AwsSolutions-IAM4",
-                    "reason": "CDK generated service role and policy",
-                },
-                {
-                    "id": "AwsSolutions-IAM5",
-                    "reason": "CDK generated service role and policy",
-                },
-            ],
-            apply_to_children=True,
-        )
-
-        NagSuppressions.add_resource_suppressions(
-            amplify_credentials_retrieval_function_role,
-            suppressions=[
-                {
-                    "id": "AwsSolutions-IAM4",
-                    "reason": "CDK generated service role and policy",
-                },
-                {
-                    "id": "AwsSolutions-IAM5",
-                    "reason": "CDK generated service role and policy",
-                },
-            ],
-            apply_to_children=True,
-        )
-
-        NagSuppressions.add_resource_suppressions_by_path(
-            self,
-            path=f"/{self.stack_name}/LogRetentionaae0aa3c5b4d4f87b02d85b201efdd8a/ServiceRole/Resource",
-            suppressions=[
-                {
-                    "id": "AwsSolutions-IAM4",
-                    "reason": "CDK generated service role and policy",
-                },
-            ],
-        )
-
-        NagSuppressions.add_resource_suppressions_by_path(
+        if get_flag(self.node, "nag") and not fast:
+            self._add_nag_suppressions(
+                amplify_username=amplify_username,
+                amplify_password=amplify_password,
+                amplify_app_distribution=amplify_app_distribution,
+                cache_invalidation_function_role=cache_invalidation_function_role,
+                password_provider=password_provider,
+                amplify_credentials_retrieval_function_role=amplify_credentials_retrieval_function_role,
+                log_retention_resource=function_log_retention is not None,
+            )
+
+    def _add_log_group(self, id, function, retention):
+        """Log group for a function, in place of the LogRetention custom resource."""
+        return LogGroup(
             self,
-            path=f"/{self.stack_name}/LogRetentionaae0aa3c5b4d4f87b02d85b201efdd8a/ServiceRole/DefaultPolicy/Resource",
-            suppressions=[
-                {
-                    "id": "AwsSolutions-IAM5",
-                    "reason": "CDK generated service role and policy",
-                },
-            ],
+            id,
+            log_group_name=f"/aws/lambda/{function.function_name}",
+            retention=retention,
+            removal_policy=RemovalPolicy.DESTROY,
         )
 
-        NagSuppressions.add_resource_suppressions_by_path(
-            self,
-            path=f"/{self.stack_name}/AWS679f53fac002430cb0da5b7982bd2287/ServiceRole/Resource",
-            suppressions=[
-                {
-                    "id": "AwsSolutions-IAM4",
-                    "reason": "CDK generated service role and policy",
-                },
-            ],
+    def _add_nag_suppressions(
+        self,
+        amplify_username,
+        amplify_password,
+        amplify_app_distribution,
+        cache_invalidation_function_role,
+        password_provider,
+        amplify_credentials_retrieval_function_role,
+        log_retention_resource,
+    ):
+        """Suppress cdk-nag findings, only needed when the AwsSolutions checks run."""
+        from cdk_nag import NagSuppressions
+
+        # (construct, suppressions, apply_to_children)
+        suppressions = (
+            (amplify_username, _SECRET_SUPPRESSIONS, False),
+            (amplify_password, _SECRET_SUPPRESSIONS, False),
+            (amplify_app_distribution, _DISTRIBUTION_SUPPRESSIONS, False),
+            (
+                cache_invalidation_function_role,
+                _CDK_GENERATED_FUNCTION_SUPPRESSIONS,
+                True,
+            ),
+            (password_provider, _CDK_GENERATED_FUNCTION_SUPPRESSIONS, True),
+            (
+                amplify_credentials_retrieval_function_role,
+                _CDK_GENERATED_ROLE_SUPPRESSIONS,
+                True,
+            ),
         )
 
-        NagSuppressions.add_resource_suppressions_by_path(
-            self,
-            path=f"/{self.stack_name}/AWS679f53fac002430cb0da5b7982bd2287/Resource",
-            suppressions=[
-                {
-                    "id": "AwsSolutions-L1",
-                    "reason": "CDK generated custom resource",
-                },
-            ],
-        )
+        path_suppressions_list = _PATH_SUPPRESSIONS
+        if log_retention_resource:
+            path_suppressions_list = (
+                path_suppressions_list + _LOG_RETENTION_PATH_SUPPRESSIONS
+            )
+
+        ns = {"sn": self.stack_name}
+        for tpl, path_suppressions in path_suppressions_list:
+            NagSuppressions.add_resource_suppressions_by_path(
+                self, path=tpl.format_map(ns), suppressions=list(path_suppressions)
+            )
+
+        for target, target_suppressions, apply_to_children in suppressions:
+            NagSuppressions.add_resource_suppressions(
+                target,
+                suppressions=list(target_suppressions),
+                apply_to_children=apply_to_children,
+            )
@@ -0,0 +1,6 @@
+TRUE_VALUES = ("1", "true", "yes")
+
+
+def get_flag(node, key):
+    """Read a boolean context flag, "-c" values from the CLI arrive as strings."""
+    return str(node.try_get_context(key)).lower() in TRUE_VALUES